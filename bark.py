@@ -1,23 +1,115 @@
 #!/usr/bin/env python3
 
 import argparse
+import contextlib
+import copy
+import importlib.util
+import itertools
 import json
+import os
+import stat
 import sys
-import requests
-import toml
-import traceback
+import threading
+import types
+
+try:
+    import fcntl
+except ModuleNotFoundError:
+    # Windows
+    fcntl = None
+
+# Optional, faster JSON (de)serialization, imported on first use as to not slow down startup
+# (False once found to be missing)
+_orjson = None
+
+
+def _import_orjson():
+    "Return the orjson module if installed, or None"
+    global _orjson
+    if _orjson is None:
+        try:
+            import orjson
+        except ModuleNotFoundError:
+            orjson = False
+        _orjson = orjson
+    return _orjson or None
+
+
+def _json_dumps(obj):
+    "Serialize obj to compact JSON with sorted keys, using orjson if installed"
+    orjson = _import_orjson()
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_SORT_KEYS).decode()
+    return json.dumps(obj, separators=(",", ":"), sort_keys=True)
+
+
+def _json_loads(data):
+    "Deserialize JSON from bytes, using orjson if installed"
+    orjson = _import_orjson()
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+class ConfigError(RuntimeError):
+    """raised when config.toml cannot be parsed"""
 
 
 class Bark:
     """class used for interfacing with the NSL API"""
 
+    # Parsed config.toml shared across instances, keyed by the file's mtime
+    _config_cache = None
+    _config_mtime = None
+
     def __init__(self):
         self.config = {}
         self.config["user"] = {}
         self.config["mission"] = {}
 
+        # Whether this instance has loaded config.toml yet
+        self._config_loaded = False
+
         self.base_url = "https://data.nsldata.com/webAPI.php"
         self.url = ""
+        self.timeout = 30
+
+        self._session = None
+        self._session_lock = threading.Lock()
+
+    @property
+    def session(self):
+        # Create session on first API call, as to not import requests for commands that never use it
+        with self._session_lock:
+            if self._session is None:
+                import requests
+
+                # Reuse one connection pool for all API calls, as to avoid a new TLS handshake per request
+                # Retry failed connections with backoff, rather than respawning the CLI
+                self._session = requests.Session()
+                self._session.mount(
+                    "https://",
+                    requests.adapters.HTTPAdapter(
+                        pool_connections=1,
+                        pool_maxsize=4,
+                        max_retries=requests.adapters.Retry(
+                            total=3, backoff_factor=0.5
+                        ),
+                    ),
+                )
+        return self._session
+
+    def close(self):
+        "Close the session's pooled connections, if a session was created"
+        if self._session is not None:
+            self._session.close()
+            self._session = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
 
     def _prompt_set_email_and_api_key(self):
         sys.exit(
@@ -32,114 +124,384 @@ class Bark:
     def _load_config(self):
         "Load config.toml, if one exists. Otherwise, create one"
         try:
-            with open("config.toml", "r") as file:
-                self.config = toml.loads(file.read())
+            mtime = os.stat("config.toml").st_mtime_ns
         except FileNotFoundError:
-            with open("config.toml", "w") as file:
-                file.write(toml.dumps(self.config))
-        except Exception:
-            traceback.print_exc()
-
-    @property
-    def email(self):
-        # Load config
-        self._load_config()
+            self._write_config(self.config)
+            self._config_loaded = True
+            return
+
+        # Only re-read config.toml if it has changed since it was last parsed
+        if mtime != Bark._config_mtime:
+            try:
+                import tomllib
+            except ModuleNotFoundError:
+                # Python < 3.11
+                import tomli as tomllib
+
+            with open("config.toml", "rb") as file:
+                try:
+                    Bark._config_cache = tomllib.load(file)
+                except tomllib.TOMLDecodeError as e:
+                    raise ConfigError(f"Unable to parse config.toml: {e}") from e
+            Bark._config_mtime = mtime
+        self.config = Bark._config_cache
+        self._config_loaded = True
+
+    def _write_config(self, config):
+        "Overwrite config.toml with config, only then making it the in-memory config"
+        import tempfile
+
+        import tomli_w
+
+        # Keep permissions of existing config file, as it holds the API key. Otherwise, restrict it to the user
+        try:
+            mode = stat.S_IMODE(os.stat("config.toml").st_mode)
+        except FileNotFoundError:
+            mode = 0o600
 
-        # Attempt to return email. Otherwise, prompt user to configure email
+        # Write to a temporary file & rename it over config.toml, as to never leave a partially written config
+        file = tempfile.NamedTemporaryFile(
+            dir=".", prefix="config.toml.", suffix=".tmp", delete=False
+        )
+        try:
+            with file:
+                tomli_w.dump(config, file)
+                file.flush()
+                os.fsync(file.fileno())
+            os.chmod(file.name, mode)
+            os.replace(file.name, "config.toml")
+        except BaseException:
+            os.unlink(file.name)
+            raise
+        self.config = Bark._config_cache = config
+        Bark._config_mtime = os.stat("config.toml").st_mtime_ns
+
+    @contextlib.contextmanager
+    def _lock_config(self):
+        "Hold an exclusive lock while reading & rewriting config.toml, as to not lose concurrent updates"
+        if fcntl is None:
+            yield
+            return
+
+        while True:
+            # Create config.toml if need be, as to have a file to lock
+            self._load_config()
+            try:
+                fd = os.open("config.toml", os.O_RDONLY)
+            except FileNotFoundError:
+                continue
+
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX)
+                # config.toml is replaced on every write, so retry if it was replaced while waiting for the lock
+                try:
+                    locked = os.fstat(fd).st_ino == os.stat("config.toml").st_ino
+                except FileNotFoundError:
+                    locked = False
+                if locked:
+                    yield
+                    return
+            finally:
+                os.close(fd)
+
+    def _set_config_values(self, values):
+        "Set config values, given as {(section, key): value}, & persist them to config.toml"
+        with self._lock_config():
+            # Load config, as to ensure other configurations persist after overwriting config file
+            self._load_config()
+
+            # Set values on a copy, as to leave the cached config untouched should writing fail
+            config = copy.deepcopy(self.config)
+
+            # Skip rewriting config file if nothing would change
+            changed = False
+            for (section, key), value in values.items():
+                if config.get(section, {}).get(key) != value:
+                    # Set value, creating its section if need be
+                    config.setdefault(section, {})[key] = value
+                    changed = True
+
+            # Overwrite existing config file
+            if changed:
+                self._write_config(config)
+
+    def _set_config_value(self, section, key, value):
+        "Set a single config value & persist it to config.toml"
+        self._set_config_values({(section, key): value})
+
+    def configure(self, email=None, api_key=None, mission_id=None):
+        "Set any of email, API key, and/or mission id, writing config.toml at most once"
+        values = {}
+        if email:
+            values["user", "email"] = email
+        if api_key:
+            values["user", "api-key"] = api_key
+        if mission_id:
+            values["mission", "id"] = mission_id
+        self._set_config_values(values)
+
+    def _get_config_value(self, section, key, prompt):
+        "Return a config value, loading config.toml on first access"
+        # Load config, if not yet loaded by this instance
+        if not self._config_loaded:
+            self._load_config()
+
+        # Attempt to return value. Otherwise, prompt user to configure it
         try:
-            return self.config["user"]["email"]
+            return self.config[section][key]
         except KeyError:
-            self._prompt_set_email_and_api_key()
+            prompt()
+
+    @property
+    def email(self):
+        return self._get_config_value(
+            "user", "email", self._prompt_set_email_and_api_key
+        )
 
     @email.setter
     def email(self, email):
-        # Load config, as to ensure other configurations persist after overwriting config file
-        self._load_config()
-
-        # Set email
-        self.config["user"]["email"] = email
-
-        # Overwrite existing config file
-        with open("config.toml", "w") as file:
-            file.write(toml.dumps(self.config))
+        self._set_config_value("user", "email", email)
 
     @property
     def api_key(self):
-        # Load config
-        self._load_config()
-
-        # Attempt to return API key. Otherwise, prompt user to configure key
-        try:
-            return self.config["user"]["api-key"]
-        except KeyError:
-            self._prompt_set_email_and_api_key()
+        return self._get_config_value(
+            "user", "api-key", self._prompt_set_email_and_api_key
+        )
 
     @api_key.setter
     def api_key(self, api_key):
-        # Load config, as to ensure other configurations persist after overwriting config file
-        self._load_config()
-
-        # Set API key
-        self.config["user"]["api-key"] = api_key
-
-        # Overwrite existing config file
-        with open("config.toml", "w") as file:
-            file.write(toml.dumps(self.config))
+        self._set_config_value("user", "api-key", api_key)
 
     @property
     def mission_id(self):
-        # Load config
-        self._load_config()
-
-        # Attempt to return mission id. Otherwise, prompt user to configure key
-        try:
-            return self.config["mission"]["id"]
-        except KeyError:
-            self._prompt_set_mission_id()
+        return self._get_config_value("mission", "id", self._prompt_set_mission_id)
 
     @mission_id.setter
     def mission_id(self, mission_id):
-        # Load config, as to ensure other configurations persist after overwriting config file
-        self._load_config()
+        self._set_config_value("mission", "id", mission_id)
 
-        # Set mission id
-        self.config["mission"]["id"] = mission_id
+    def load_credentials(self):
+        "Return (email, api_key, mission_id), prompting for any that aren't configured"
+        return self.email, self.api_key, self.mission_id
 
-        # Overwrite existing config file
-        with open("config.toml", "w") as file:
-            file.write(toml.dumps(self.config))
+    def _prepare_request(self, method, params=None):
+        import requests
 
-    def _get_request_url(self, method, params={}):
-        return "".join(
-            [
+        if params is None:
+            params = {}
+
+        # Let requests percent-encode the query string, rather than concatenating it by hand
+        return self.session.prepare_request(
+            requests.Request(
+                "GET",
                 self.base_url,
-                "?email=",
-                self.email,
-                "&apiKey=",
-                self.api_key,
-                "&method=",
-                method,
-                "&params=",
-                json.dumps(params),
-            ]
+                params={
+                    "email": self.email,
+                    "apiKey": self.api_key,
+                    "method": method,
+                    "params": _json_dumps(params),
+                },
+            )
         )
 
-    def _load_url_and_parse_json(self, url):
-        r = requests.get(url)
-        return r.json()
+    def _send(self, request, stream=False):
+        import requests
+
+        try:
+            return self.session.send(request, timeout=self.timeout, stream=stream)
+        except requests.RequestException as e:
+            raise RuntimeError(f"Unable to reach the NSL API: {e}") from e
 
-    def console_api(self, method, params={}):
-        self.url = self._get_request_url(method, params)
-        result = self._load_url_and_parse_json(self.url)
+    def _load_url_and_parse_json(self, request):
+        r = self._send(request)
+        try:
+            return _json_loads(r.content)
+        except ValueError as e:
+            raise RuntimeError(
+                f"Unable to parse response from the NSL API (HTTP {r.status_code})"
+            ) from e
+
+    def _api_error(self, method, result):
+        return RuntimeError(
+            f"Error from api call {method}\n"
+            f"  result.errorCode: {result.get('errorCode')}\n"
+            f"  result.description: {result.get('description')}\n"
+            f"  result.return: {result.get('return')}"
+        )
+
+    def _parse_json_items(self, r, method, key):
+        import ijson
+        import requests
+        import urllib3
+
+        # Keep the raw body only until the first item arrives, as to parse success/errorCode from it
+        # if none do, rather than inspecting every parse event in Python
+        body = bytearray()
+        recording = True
+
+        def read(size=-1):
+            data = r.raw.read(size)
+            if recording:
+                body.extend(data)
+            return data
+
+        with r:
+            r.raw.decode_content = True
+            items = ijson.items(
+                types.SimpleNamespace(read=read), f"return.{key}.item", use_float=True
+            )
+            try:
+                for item in items:
+                    recording = False
+                    body.clear()
+                    yield item
+                    break
+                yield from items
+            except ijson.JSONError as e:
+                raise RuntimeError(
+                    f"Unable to parse response from the NSL API (HTTP {r.status_code})"
+                ) from e
+            except (requests.RequestException, urllib3.exceptions.HTTPError) as e:
+                # Reading r.raw skips requests' own wrapping of e.g. timeouts or dropped connections
+                raise RuntimeError(f"Unable to reach the NSL API: {e}") from e
+
+        # Items are only returned on success, so only an empty/missing array needs checking
+        if recording:
+            result = _json_loads(bytes(body))
+            if not result["success"]:
+                raise self._api_error(method, result)
+
+    def _call_api(self, method, request):
+        "Send a prepared request for method & return its result, without updating self.url"
+        result = self._load_url_and_parse_json(request)
         if not result["success"]:
-            print("Error from api call", method)
-            print("  result.errorCode:", result["errorCode"])
-            print("  result.description:", result["description"])
-            print("  result.return:", result["return"])
-            exit(0)
+            raise self._api_error(method, result)
         else:
             return result["return"]
 
+    def console_api(self, method, params=None):
+        request = self._prepare_request(method, params)
+        self.url = request.url
+        return self._call_api(method, request)
+
+    def console_api_items(self, method, params, key):
+        """Call method once iterated, lazily parsing each item of the array returned under key as it is received"""
+        # Without ijson, parse the whole response up front
+        if importlib.util.find_spec("ijson") is None:
+            yield from self.console_api(method, params)[key]
+            return
+
+        request = self._prepare_request(method, params)
+        self.url = request.url
+        yield from self._parse_json_items(self._send(request, stream=True), method, key)
+
+
+def _cmd_config(bark, args):
+    "Configure/update config.toml, if passed as arguments"
+    bark.configure(email=args.email, api_key=args.api_key, mission_id=args.mission_id)
+
+
+def _cmd_info(bark, args):
+    "Request mission info"
+    # Load credentials up front, as to prompt for any missing ones before calling the API
+    _, _, mission_id_to_fetch = bark.load_credentials()
+
+    # Print full url of API call without sending it, if --dry-run flag is passed
+    if args.dry_run:
+        print(
+            bark._prepare_request(
+                "getMissionDetails", {"missionID": mission_id_to_fetch}
+            ).url
+        )
+        return
+
+    mission_details = bark.console_api(
+        "getMissionDetails", {"missionID": mission_id_to_fetch}
+    )
+    result_as_formatted_string = json.dumps(mission_details, indent=2)
+
+    # Prepend output with full url of API call, if --verbose flag is also passed
+    if args.verbose:
+        print(bark.url)
+
+    print(result_as_formatted_string)
+
+
+def _cmd_ls(bark, args):
+    "Request list of packets"
+    import concurrent.futures
+
+    # Load credentials up front, as to prompt for any missing ones before calling the API
+    _, _, mission_id_to_fetch = bark.load_credentials()
+
+    # Print full urls of API calls without sending them, if --dry-run flag is passed
+    if args.dry_run:
+        for method in ("getMissionDetails", "getConsoleMissionPackets"):
+            print(bark._prepare_request(method, {"missionID": mission_id_to_fetch}).url)
+        return
+
+    # Request mission details in the background, while streaming recent packets.
+    # The request is prepared here, as to only update bark.url from this thread
+    mission_details_request = bark._prepare_request(
+        "getMissionDetails", {"missionID": mission_id_to_fetch}
+    )
+    most_recent_packets_any_radio_or_format = bark.console_api_items(
+        "getConsoleMissionPackets",
+        {"missionID": mission_id_to_fetch},
+        "lastAnyRadioOrFormat",
+    )
+    with contextlib.closing(most_recent_packets_any_radio_or_format):
+        with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
+            mission_details_future = executor.submit(
+                bark._call_api, "getMissionDetails", mission_details_request
+            )
+
+            # Start streaming packets, as to raise any API error before printing the listing
+            first_packets = list(
+                itertools.islice(most_recent_packets_any_radio_or_format, 1)
+            )
+            mission_details = mission_details_future.result()
+
+        # Prepend output with full url of API call, if --verbose flag is also passed
+        if args.verbose:
+            print(bark.url)
+
+        _print_packets(
+            mission_details,
+            itertools.chain(first_packets, most_recent_packets_any_radio_or_format),
+        )
+
+
+def _print_packets(mission_details, packets):
+    "Print packets, naming their radio views & downlink formats from mission details"
+    # Map radio view & downlink format IDs to their names once, rather than per packet.
+    # Keys are strings, as in the API's JSON, since packets may carry IDs as either ints or strings
+    radio_view_names = {
+        radio_view_id: radio_view["radioViewName"]
+        for radio_view_id, radio_view in mission_details["radioViews"].items()
+    }
+    format_names = {
+        format_id: downlink_format["formatName"]
+        for format_id, downlink_format in mission_details["downlinkFormats"].items()
+    }
+
+    # Write each packet as it is parsed, with a single write per packet
+    write = sys.stdout.write
+    try:
+        write("Most Recent Packets, Any Radio/Format\n")
+        for packet in packets:
+            radio_view_name = radio_view_names[str(packet["radioViewID"])]
+            format_name = format_names[str(packet["formatID"])]
+            write(
+                f"   {radio_view_name} {format_name}\n"
+                f"      {packet['gatewayTS']} UTC\n"
+                f"      {packet['numBytes']} bytes\n"
+                f"      {packet['packetFields']}\n"
+            )
+    finally:
+        # Flush what was parsed so far, even if the stream fails part way
+        sys.stdout.flush()
+
 
 if __name__ == "__main__":
     # Setup parser
@@ -157,6 +519,7 @@ if __name__ == "__main__":
     parser_config.add_argument("--email", type=str, required=True, help="Set email")
     parser_config.add_argument("--api-key", type=str, required=True, help="Set API key")
     parser_config.add_argument("--mission-id", type=str, help="Set Mission ID")
+    parser_config.set_defaults(func=_cmd_config)
 
     # Create parser with args for requesting mission info
     parser_info = subparsers.add_parser("info", help="Request mission info")
@@ -166,6 +529,13 @@ if __name__ == "__main__":
         action="store_true",
         help="Enable verbosity (prints full API call)",
     )
+    parser_info.add_argument(
+        "-n",
+        "--dry-run",
+        action="store_true",
+        help="Print full API call without sending it",
+    )
+    parser_info.set_defaults(func=_cmd_info)
 
     # Create parser with args for requesting packets info
     parser_packets = subparsers.add_parser("ls", help="Request list of packets")
@@ -175,6 +545,13 @@ if __name__ == "__main__":
         action="store_true",
         help="Enable verbosity (prints full API call)",
     )
+    parser_packets.add_argument(
+        "-n",
+        "--dry-run",
+        action="store_true",
+        help="Print full API call without sending it",
+    )
+    parser_packets.set_defaults(func=_cmd_ls)
 
     # Print help text if no arguments passed
     if len(sys.argv) == 1:
@@ -184,58 +561,11 @@ if __name__ == "__main__":
     # Parse arguments
     args = parser.parse_args()
 
-    # Setup bark instance
-    bark = Bark()
-
-    # Configure/update config.toml, if passed as arguments
-    if args.command == "config":
-        if args.email:
-            bark.email = args.email
-        if args.api_key:
-            bark.api_key = args.api_key
-        if args.mission_id:
-            bark.mission_id = args.mission_id
-
-    # Request mission info
-    if args.command == "info":
-        mission_id_to_fetch = bark.mission_id
-        mission_details = bark.console_api(
-            "getMissionDetails", {"missionID": mission_id_to_fetch}
-        )
-        result_as_formatted_string = json.dumps(mission_details, indent=2)
-
-        # Prepend output with full url of API call, if --verbose flag is also passed
-        if args.verbose:
-            print(bark.url)
-
-        print(result_as_formatted_string)
-
-    # Request list of packets
-    if args.command == "ls":
-        mission_id_to_fetch = bark.mission_id
-        mission_details = bark.console_api(
-            "getMissionDetails", {"missionID": mission_id_to_fetch}
-        )
-        recent_packets = bark.console_api(
-            "getConsoleMissionPackets", {"missionID": mission_id_to_fetch}
-        )
-
-        # Prepend output with full url of API call, if --verbose flag is also passed
-        if args.verbose:
-            print(bark.url)
-
-        print("Most Recent Packets, Any Radio/Format")
-        most_recent_packets_any_radio_or_format = recent_packets["lastAnyRadioOrFormat"]
-        for packet in most_recent_packets_any_radio_or_format:
-            radio_view_id = packet["radioViewID"]
-            radio_view_name = mission_details["radioViews"][str(radio_view_id)][
-                "radioViewName"
-            ]
-            format_id = packet["formatID"]
-            format_name = mission_details["downlinkFormats"][str(format_id)][
-                "formatName"
-            ]
-            print("  ", radio_view_name, format_name)
-            print("     ", packet["gatewayTS"], "UTC")
-            print("     ", packet["numBytes"], "bytes")
-            print("     ", packet["packetFields"])
+    # Setup bark instance, closing its connections once done
+    try:
+        with Bark() as bark:
+            # Dispatch to the handler bound to the subcommand
+            args.func(bark, args)
+    except RuntimeError as e:
+        # Report errors (e.g. from the NSL API or config.toml) & exit with a failure status
+        sys.exit(e)